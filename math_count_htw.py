@@ -1,13 +1,44 @@
-from typing import Union, List
+from dataclasses import dataclass
 import math
+from fractions import Fraction
+import re
+import functools
 import discord
-import datetime
+import asyncio
 import os
 
 COUNTING_CHANNEL_ID = 1445504113470341212
+# messages starting with these are never evaluated
+_CMD_PREFIXES = ("?", "\\")
 
-allowed_digits = {"1", "2", "3", "4", "5", "6"}
-allowed_operators = {"+", "-", "*", "/", "^", "!"}
+# limits that keep evaluation cheap, e.g. for "6^5^4" or "(6!)!"
+MAX_FACTORIAL = 20
+# powers estimated to need more bits than this are computed in float instead of exactly
+MAX_POWER_BITS = 256
+
+allowed_digits = frozenset("123456")
+allowed_operators = frozenset("+-*/^!")
+
+# whitespace and backticks are ignored anywhere in an expression
+# (U+3000 is the highest code point for which str.isspace() is true)
+_DEL_TABLE = str.maketrans("", "", "`" + "".join(c for c in map(chr, range(0x3001)) if c.isspace()))
+_INVALID_RE = re.compile(r"[^1-6+\-*/^!()]")
+
+# error messages
+_ERR_EMPTY = "Leere Eingabe."
+_ERR_UNEXPECTED_END = "Unerwartetes Ende der Eingabe. Wert erwartet."
+_ERR_CLOSING_PAREN = "Schließende Klammer erwartet."
+_ERR_VALUE_EXPECTED = "Ungültiges Zeichen. Wert erwartet."
+_ERR_TRAILING = "Zusätzliche Zeichen nach gültigem Ausdruck."
+_ERR_INVALID_CHAR = "Ungültiges Zeichen."
+_ERR_INVALID_DIGIT = "Unzulässige Ziffer."
+_ERR_DIGIT_REUSED = "Ziffer mehrfach verwendet."
+_ERR_DIV_ZERO = "Division durch 0"
+_ERR_FACT_NEGATIVE = "Fakultät auf nicht-ganze oder negative Zahl angewendet."
+_ERR_FACT_TOO_LARGE = "Fakultät zu groß."
+_ERR_POW_TOO_LARGE = "Potenz zu groß."
+_ERR_POW_ZERO_NEGATIVE = "Ungültige Potenz: 0 hoch negative Zahl"
+_ERR_POW_COMPLEX = "Ungültige Potenz: komplexes Ergebnis"
 
 class ParsingError(Exception):
     def __init__(self, char: str, msg: str):
@@ -19,116 +50,148 @@ class ParsingError(Exception):
             return f"Fehler bei Zeichen {self.char}: {self.msg}"
         return f"Fehler: {self.msg}"
 
-class Parser:
-    def __init__(self, text: str):
-        self.text = text
-        self.i = 0
-        self.len = len(text)
-        self.used_digits = set()
-
-    def _peek(self) -> str:
-        return self.text[self.i] if self.i < self.len else ""
+PUSH, ADD, SUB, MUL, DIV, POW, FACT = range(7)
 
-    def _next(self) -> str:
-        ch = self._peek()
-        self.i += 1
-        return ch
+binary_opcodes = {"+": ADD, "-": SUB, "*": MUL, "/": DIV, "^": POW}
+precedence = {"+": 1, "-": 1, "*": 2, "/": 2, "^": 3}
 
-    def _skip_spaces(self):
-        while self._peek().isspace() or self._peek() == "`":
-            self._next()
+def clean_expression(text: str) -> str:
+    """
+    Remove whitespace and backticks and check that only allowed characters remain.
+    """
+    text = text.translate(_DEL_TABLE)
+    invalid = _INVALID_RE.search(text)
+    if invalid is not None:
+        ch = invalid.group()
+        if "0" <= ch <= "9":
+            raise ParsingError(ch, _ERR_INVALID_DIGIT)
+        raise ParsingError(ch, _ERR_INVALID_CHAR)
+    return text
 
-    def parse_expression(self) -> float:
-        # expression := term ((+|-) term)*
-        val = self.parse_term()
-        while True:
-            self._skip_spaces()
-            ch = self._peek()
-            if ch in ("+", "-"):
-                op = self._next()
-                rhs = self.parse_term()
-                if op == "+":
-                    val = val + rhs
-                else:
-                    val = val - rhs
+def compile_to_rpn(text: str) -> list[tuple[int, int]]:
+    """
+    Compile expression into a list of (opcode, argument) instructions in reverse polish notation.
+    Uses Dijkstra's shunting-yard algorithm in a single pass over the tokens.
+    Raises ParsingError on syntax errors and invalid or repeated digits.
+    """
+    text = clean_expression(text)
+    if not text:
+        raise ParsingError("", _ERR_EMPTY)
+    prog = []
+    ops = []  # pending operators, "(" for open parentheses
+    depth = 0
+    used = 0  # bitmask of used digits
+    expect_value = True
+    # every token is a single character, so the cleaned text is the token stream
+    for ch in text:
+        if expect_value:
+            # value := DIGIT | '('
+            if ch == "(":
+                ops.append(ch)
+                depth += 1
+            elif "1" <= ch <= "6":
+                digit = ord(ch) - 48
+                bit = 1 << digit
+                if used & bit:
+                    raise ParsingError(ch, _ERR_DIGIT_REUSED)
+                used |= bit
+                prog.append((PUSH, digit))
+                expect_value = False
             else:
-                break
-        return val
+                raise ParsingError(ch, _ERR_VALUE_EXPECTED)
+        elif ch == "!":
+            # factorial binds tighter than any binary operator
+            prog.append((FACT, 0))
+        elif ch in precedence:
+            if ch != "^":  # "^" is right-associative
+                prec = precedence[ch]
+                while ops and ops[-1] != "(" and precedence[ops[-1]] >= prec:
+                    prog.append((binary_opcodes[ops.pop()], 0))
+            ops.append(ch)
+            expect_value = True
+        elif ch == ")" and depth > 0:
+            op = ops.pop()
+            while op != "(":
+                prog.append((binary_opcodes[op], 0))
+                op = ops.pop()
+            depth -= 1
+        elif depth > 0:
+            raise ParsingError(")", _ERR_CLOSING_PAREN)
+        else:
+            # leftover characters
+            raise ParsingError(ch, _ERR_TRAILING)
+    if expect_value:
+        raise ParsingError("", _ERR_UNEXPECTED_END)
+    if depth > 0:
+        raise ParsingError(")", _ERR_CLOSING_PAREN)
+    while ops:
+        prog.append((binary_opcodes[ops.pop()], 0))
+    return prog
 
-    def parse_term(self) -> float:
-        # term := power ((*|/) power)*
-        val = self.parse_power()
-        while True:
-            self._skip_spaces()
-            ch = self._peek()
-            if ch in ("*", "/"):
-                op = self._next()
-                rhs = self.parse_power()
-                if op == "*":
-                    val = val * rhs
-                else:
-                    if rhs == 0:
-                        raise ParsingError("/", "Division durch 0")
+def evaluate_rpn(prog: list[tuple[int, int]]) -> int | Fraction | float:
+    """
+    Evaluate instructions produced by compile_to_rpn on a value stack.
+    Arithmetic is exact: whole numbers are int, quotients are Fraction.
+    Only non-integer powers fall back to float.
+    """
+    stack = []
+    for op, arg in prog:
+        if op == PUSH:
+            stack.append(arg)
+        elif op == FACT:
+            val = stack[-1]
+            # factorial only defined for non-negative integers
+            if not isinstance(val, int) or val < 0:
+                raise ParsingError("!", _ERR_FACT_NEGATIVE)
+            if val > MAX_FACTORIAL:
+                raise ParsingError("!", _ERR_FACT_TOO_LARGE)
+            stack[-1] = math.factorial(val)
+        else:
+            rhs = stack.pop()
+            val = stack[-1]
+            if op == ADD:
+                val = val + rhs
+            elif op == SUB:
+                val = val - rhs
+            elif op == MUL:
+                val = val * rhs
+            elif op == DIV:
+                if rhs == 0:
+                    raise ParsingError("/", _ERR_DIV_ZERO)
+                if isinstance(val, float) or isinstance(rhs, float):
                     val = val / rhs
+                else:
+                    val = Fraction(val, rhs)
             else:
-                break
-        return val
-
-    def parse_power(self) -> float:
-        # power := factor (^ power)?
-        val = self.parse_factor()
-        self._skip_spaces()
-        if self._peek() == "^":
-            self._next()
-            rhs = self.parse_power()  # right-associative
-            try:
-                val = val ** rhs
-            except Exception as e:
-                raise ParsingError("^", f"Ungültige Potenz: {e}")
-        return val
-
-    def parse_factor(self) -> float:
-        # factor := primary ('!')*
-        val = self.parse_primary()
-        self._skip_spaces()
-        while self._peek() == "!":
-            self._next()
-            # factorial only defined for non-negative integers
-            if not float(val).is_integer() or val < 0:
-                raise ParsingError("!", "Fakultät auf nicht-ganze oder negative Zahl angewendet.")
-            n = int(val)
-            try:
-                val = math.factorial(n)
-            except Exception as e:
-                raise ParsingError("!", f"Fakultätfehler: {e}")
-            self._skip_spaces()
-        return val
+                if isinstance(rhs, int) and rhs < 0 and not isinstance(val, float):
+                    # keep negative powers exact instead of letting int ** int return float
+                    if val == 0:
+                        raise ParsingError("^", _ERR_POW_ZERO_NEGATIVE)
+                    val = Fraction(val)
+                # float powers are always cheap, and 0, 1 and -1 stay small for any exponent
+                cheap = isinstance(val, float) or (abs(val) <= 1 and val.denominator == 1)
+                try:
+                    if isinstance(rhs, int) and not cheap:
+                        # (bits - 1) * |rhs| is a lower bound on the size of the exact result
+                        bits = max(val.numerator.bit_length(), val.denominator.bit_length())
+                        if (bits - 1) * abs(rhs) > MAX_POWER_BITS:
+                            val = float(val)
+                    val = val ** rhs
+                except OverflowError:
+                    raise ParsingError("^", _ERR_POW_TOO_LARGE)
+                except (ZeroDivisionError, ValueError) as e:
+                    raise ParsingError("^", f"Ungültige Potenz: {e}")
+                if isinstance(val, complex):
+                    raise ParsingError("^", _ERR_POW_COMPLEX)
+                if isinstance(val, float) and val.is_integer():
+                    val = int(val)
+            # keep whole numbers as int
+            if isinstance(val, Fraction) and val.denominator == 1:
+                val = val.numerator
+            stack[-1] = val
+    return stack[0]
 
-    def parse_primary(self) -> float:
-        # primary := DIGIT | '(' expression ')'
-        self._skip_spaces()
-        ch = self._peek()
-        if ch == "(":
-            self._next()
-            val = self.parse_expression()
-            self._skip_spaces()
-            if self._peek() != ")":
-                raise ParsingError(")", "Schließende Klammer erwartet.")
-            self._next()
-            return val
-        if ch.isdigit():
-            digit = self._next()
-            if digit not in allowed_digits:
-                raise ParsingError(digit, "Unzulässige Ziffer.")
-            if digit in self.used_digits:
-                raise ParsingError(digit, "Ziffer mehrfach verwendet.")
-            self.used_digits.add(digit)
-            return float(int(digit))
-        if ch == "":
-            raise ParsingError("", "Unerwartetes Ende der Eingabe. Wert erwartet.")
-        raise ParsingError(ch, "Ungültiges Zeichen. Wert erwartet.")
-
-def parse(text: str) -> Union[int, float]:
+def parse(text: str) -> int | float:
     """
     Parse and evaluate expression like "5*(4+3)+6!".
     Rules:
@@ -139,51 +202,90 @@ def parse(text: str) -> Union[int, float]:
     - On error raise ParsingError with informative message
     - On success return numeric value (int if whole number)
     """
-    parser = Parser(text)
-    val = None
+    result = _parse_cached(text)
+    if result[0] == "err":
+        raise ParsingError(result[1], result[2])
+    return result[1]
+
+@functools.lru_cache(maxsize=4096)
+def _parse_cached(text: str) -> tuple:
+    # The grammar is pure, so results (including errors) can be cached by input text.
+    # Errors are stored as ("err", char, msg), successes as ("ok", value).
     try:
-        parser._skip_spaces()
-        if parser.i >= parser.len:
-            raise ParsingError("", "Leere Eingabe.")
-        val = parser.parse_expression()
-        parser._skip_spaces()
-        if parser.i != parser.len:
-            # leftover characters
-            raise ParsingError(parser._peek(), "Zusätzliche Zeichen nach gültigem Ausdruck.")
-    except ParsingError:
-        raise
-    # return int if integer-valued
-    if isinstance(val, float) and val.is_integer():
-        return int(val)
+        return ("ok", _evaluate(text))
+    except ParsingError as error:
+        return ("err", error.char, error.msg)
+
+def _evaluate(text: str) -> int | float:
+    """
+    Compile and evaluate expression without caching, converting the result for output.
+    """
+    val = evaluate_rpn(compile_to_rpn(text))
+    # whole numbers are already int, remaining fractions are reported as float
+    if isinstance(val, Fraction):
+        val = float(val)
+        # a fraction can round to a whole float, e.g. "6!/4+2/3^5!", which is shown as int
+        if val.is_integer():
+            return int(val)
     return val
 
+def parse_batch(texts: list[str]) -> list[int | float | None]:
+    """
+    Parse and evaluate many expressions at once, e.g. to replay a message history.
+    Invalid expressions yield None instead of raising ParsingError.
+    Bypasses the parse cache so bulk input doesn't evict entries of the live game.
+    """
+    results = []
+    for text in texts:
+        try:
+            results.append(_evaluate(text))
+        except ParsingError:
+            results.append(None)
+    return results
+
 # =================================================================================================
 
+_RULES_TEXT = """
+**Regeln**
+1. Ihr zählt gemeinsam von 1 beginnend.
+2. Schickt eine Nachricht mit einem mathematischen Ausdruck, um zu zählen.
+3. Die einzigen zulässigen Operanden sind die Ziffern 1-6.
+4. Die einzigen zulässigen Operatoren sind `+ - * / ^ !`.
+5. Klammern mit `()` sind erlaubt.
+6. Jede Nachricht, die nicht mit `?` oder `\\` beginnt, wird ausgewertet.
+7. Nachrichten dürfen von Backticks (`) umschlossen sein.
+8. Ein Spieler darf nicht mehrmals hintereinander zählen.
+9. Um diese Regeln anzuzeigen, `?rules` eingeben.
+            """
+
 intents = discord.Intents.default()
 intents.message_content = True
 bot = discord.Client(intents=intents)
 
-current_count = 0
-game_started = False
-cooldown_until = None
-last_player_id = None
-current_highscore = 0
-current_highscore_player_name = None
+@dataclass(slots=True)
+class GameState:
+    current_count: int = 0
+    game_started: bool = False
+    cooldown_until: float | None = None  # event loop time (monotonic seconds)
+    last_player_id: int | None = None
+    current_highscore: int = 0
+    current_highscore_player_name: str | None = None
+
+state = GameState()
 
 async def end_game(message, text: str, cooldown: int):
-    global current_count, game_started, cooldown_until, last_player_id, current_highscore, current_highscore_player_name
-    await message.add_reaction("❌")
-    await message.channel.send(text)
-    await message.channel.send(
-        f"Das Spiel ist vorbei. Ihr seid bis `{current_count}` gekommen. Danke fürs Mitspielen! Nächster Versuch in {cooldown} Minuten."
+    text = (
+        f"{text}\nDas Spiel ist vorbei. Ihr seid bis `{state.current_count}` gekommen. "
+        f"Danke fürs Mitspielen! Nächster Versuch in {cooldown} Minuten."
     )
 
-    current_count = 0
-    game_started = False
-    cooldown_until = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
-        minutes=cooldown
-    )
-    last_player_id = None
+    state.current_count = 0
+    state.game_started = False
+    state.cooldown_until = asyncio.get_running_loop().time() + cooldown * 60
+    state.last_player_id = None
+
+    # one message, sent concurrently with the reaction
+    await asyncio.gather(message.add_reaction("❌"), message.channel.send(text))
 
 @bot.event
 async def on_ready():
@@ -193,39 +295,27 @@ async def on_ready():
     
 @bot.event
 async def on_message(message):
-    global current_count, game_started, cooldown_until, last_player_id, current_highscore, current_highscore_player_name
-    if message.author == bot.user or message.content[0] == "\\":
+    content = message.content
+    if message.author == bot.user or not content or content.startswith("\\"):
         return
     if message.channel.id == COUNTING_CHANNEL_ID:
-        if message.content == "?rules" or message.content == "?help":
-            await message.channel.send("""
-**Regeln**
-1. Ihr zählt gemeinsam von 1 beginnend.
-2. Schickt eine Nachricht mit einem mathematischen Ausdruck, um zu zählen.
-3. Die einzigen zulässigen Operanden sind die Ziffern 1-6.
-4. Die einzigen zulässigen Operatoren sind `+ - * / ^ !`.
-5. Klammern mit `()` sind erlaubt.
-6. Jede Nachricht, die nicht mit `?` oder `\\` beginnt, wird ausgewertet.
-7. Nachrichten dürfen von Backticks (`) umschlossen sein.
-8. Ein Spieler darf nicht mehrmals hintereinander zählen.
-9. Um diese Regeln anzuzeigen, `?rules` eingeben.
-            """)
+        if content == "?rules" or content == "?help":
+            await message.channel.send(_RULES_TEXT)
             return
-        if message.content == "?highscore":
-            if current_highscore == 0:
+        if content == "?highscore":
+            if state.current_highscore == 0:
                 await message.channel.send("Ihr habt es schon sehr weit geschafft: `0`. Fang doch einfach an.")
                 return
-            await message.channel.send(f"Highscore: `{current_highscore}`, erreicht von {current_highscore_player_name}")
+            await message.channel.send(f"Highscore: `{state.current_highscore}`, erreicht von {state.current_highscore_player_name}")
             return
-        if message.content[0] in ["?", "\\"]:
+        if content.startswith(_CMD_PREFIXES):
             return
         # Check cooldown
-        if cooldown_until is not None:
-            now = datetime.datetime.now(datetime.timezone.utc)
-            if now < cooldown_until:
-                remaining = cooldown_until - now
+        if state.cooldown_until is not None:
+            now = asyncio.get_running_loop().time()
+            if now < state.cooldown_until:
+                remaining_seconds = round(state.cooldown_until - now)
                 await message.add_reaction("⏳")
-                remaining_seconds = round(remaining.total_seconds())
                 if remaining_seconds > 3 * 60:
                     remaining_text = f"~{round(remaining_seconds / 60)} Minuten"
                 else:
@@ -235,12 +325,12 @@ async def on_message(message):
                 )
                 return
             else:
-                cooldown_until = None
+                state.cooldown_until = None
 
         # Check game start
-        if not game_started:
-            if message.content.strip().lower() == "start":
-                game_started = True
+        if not state.game_started:
+            if content.strip().lower() == "start":
+                state.game_started = True
                 await message.channel.send("Na endlich. Spiel läuft. Fangt bei `3-2` an. Oder `1`, wenn ihr faul seid.")
                 return
             else:
@@ -251,31 +341,37 @@ async def on_message(message):
         # Parse expression
         try:
             # Check double turn
-            if last_player_id is not None and message.author.id == last_player_id:
-                await message.add_reaction("❌")
+            if state.last_player_id is not None and message.author.id == state.last_player_id:
                 await end_game(
                     message,
                     f"{message.author.mention} `4/2` Züge hintereinander? Das hier ist kein Solo.",
-                    cooldown=max(2, current_count + 1),
+                    cooldown=max(2, state.current_count + 1),
                 )
                 return
             
-            new_value = parse(message.content.strip())
-            if new_value == current_count + 1:
-                current_count += 1
-                last_player_id = message.author.id
+            expression = content.strip().strip("`").strip()
+            if expression in allowed_digits:
+                # fast path for the common single-digit count
+                new_value = int(expression)
+            else:
+                # evaluated inline on purpose: the size caps keep this to microseconds,
+                # and not awaiting here keeps the double-turn check and the count update atomic
+                new_value = parse(expression)
+            if new_value == state.current_count + 1:
+                state.current_count += 1
+                state.last_player_id = message.author.id
 
-                if current_count > current_highscore:
-                    current_highscore = current_count
-                    current_highscore_player_name = message.author.display_name
+                if state.current_count > state.current_highscore:
+                    state.current_highscore = state.current_count
+                    state.current_highscore_player_name = message.author.display_name
                 await message.add_reaction("✅")
             else:
                 await end_game(
                     message,
-                    f"{message.author.mention} Wer genau zählen kann, ist klar im Vorteil. {message.content} = {new_value}. Erwartet: {current_count + 1}",
-                    cooldown=max(2, current_count + 1)
+                    f"{message.author.mention} Wer genau zählen kann, ist klar im Vorteil. {content} = {new_value}. Erwartet: {state.current_count + 1}",
+                    cooldown=max(2, state.current_count + 1)
                 )
         except ParsingError as error:
-            await end_game(message, f"{error}", cooldown=max(2, current_count + 1))
+            await end_game(message, f"{error}", cooldown=max(2, state.current_count + 1))
 
 bot.run(os.environ["TOKEN"])
\ No newline at end of file